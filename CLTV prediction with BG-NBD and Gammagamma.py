@@ -32,11 +32,22 @@
 # 1 - Data Preparation
 ###############################################################
 import datetime as dt
+import math
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+import pyarrow as pa
+import pyarrow.compute as pc
+import xxhash
+import lifetimes
 from lifetimes import BetaGeoFitter
 from lifetimes import GammaGammaFitter
-from lifetimes.plotting import plot_period_transactions
+from lifetimes.generate_data import beta_geometric_nbd_model
+from lifetimes.utils import ConvergenceError, _scale_time
+from numba import njit
+from scipy.optimize import minimize
+from scipy.special import hyp2f1
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 100)
@@ -44,13 +55,11 @@ pd.set_option('display.float_format', lambda x: '%.4f' % x)
 from sklearn.preprocessing import MinMaxScaler
 # To scale the values between 0-1 or 0-100 for lifetime value
 
-df_ = pd.read_csv('Datasets/flo_data_20k.csv')
-df = df_.copy()
-df.head()
-
 # Data understanding
 ##############################################
-def check_df(dataframe, head=5):
+def check_df(dataframe, head=5, verbose=True):
+    if not verbose:
+        return
     print('################# Columns ################# ')
     print(dataframe.columns)
     print('################# Types  ################# ')
@@ -65,13 +74,11 @@ def check_df(dataframe, head=5):
     print(dataframe.describe([0, 0.05, 0.50, 0.95, 0.99]).T)
     print('')
 
-check_df(df)
-
 # Define the outlier_thresholds and replace_with_thresholds functions to suppress outliers
 ###########################################################################################
+# (a list of variables is handled in one quantile call and one clip over all of them)
 def outlier_thresholds(dataframe, variable):
-    quartile1 = dataframe[variable].quantile(0.01)
-    quartile3 = dataframe[variable].quantile(0.99)
+    quartile1, quartile3 = dataframe[variable].quantile([0.01, 0.99]).to_numpy(dtype=float)
     interquantile_range = quartile3 - quartile1
     up_limit = quartile3 + 1.5 * interquantile_range
     low_limit = quartile1 - 1.5 * interquantile_range
@@ -79,194 +86,316 @@ def outlier_thresholds(dataframe, variable):
 
 def replace_with_thresholds(dataframe, variable):
     low_limit, up_limit = outlier_thresholds(dataframe, variable)
-    low_limit = round(low_limit)
-    up_limit = round(up_limit)
-    dataframe.loc[(dataframe[variable] < low_limit), variable] = low_limit
-    dataframe.loc[(dataframe[variable] > up_limit), variable] = up_limit
-
-# Suppress the outliers in the variables "order_num_total_ever_online", "order_num_total_ever_offline",
-# "customer_value_total_ever_offline", "customer_value_total_ever_online".
-#######################################################################################################
-df.describe().T #--> as seen that, there are big defference between mean, %75 and max values of this 4 variables.
-columns = ["order_num_total_ever_online", "order_num_total_ever_offline",
-           "customer_value_total_ever_offline","customer_value_total_ever_online"]
-for col in columns:
-    replace_with_thresholds(df, col)
-
-df.describe().T #--> after suppression max values decreased.
-
-# Create new variables for the total number of purchases and total amount spent by omnichannel customers.
-#########################################################################################################
-df['order_num_total'] = df['order_num_total_ever_online'] + df['order_num_total_ever_offline']
-df['customer_value_total'] = df['customer_value_total_ever_offline'] + df['customer_value_total_ever_online']
-
-# Examine variable types. Convert the date variables to the date type.
-######################################################################
-date_columns = df.columns[df.columns.str.contains("date")]
-df[date_columns] = df[date_columns].apply(pd.to_datetime)
-df.dtypes
-
-###############################################################
-# 2 - Preparing Data for CLTV Calculation
-###############################################################
-
-# Take the date of the last purchase in the dataset as the analysis date, 2 days after.
-########################################################################################
-df["last_order_date"].max()
-analysis_date = dt.datetime(2021, 6, 3)
-
-# Create a new cltv dataframe containing customer_id, recency_cltv_weekly, T_weekly,
-# frequency, and monetary_cltv_avg values.
-####################################################################################
-cltv = pd.DataFrame()
-cltv["customer_id"] = df["master_id"]
-cltv['recency_cltv_weekly'] = (df['last_order_date'] - df['first_order_date']).dt.days // 7
-cltv['T_weekly'] = (analysis_date - df['first_order_date']).dt.days // 7
-cltv['frequency'] = df['order_num_total']
-cltv = cltv[(cltv['frequency'] > 1)]
-cltv['monetary_cltv_avg'] = df['customer_value_total'] / cltv['frequency']
-cltv.describe().T
-
-###############################################################################
-# 3. Calculating CLTV with BG/NBD and Gamma-Gamma Models
-###############################################################################
-
-# A. Predicting purchases using the BG/NBD model
-################################################
-# Fitting the BG/NBD model
-######################
-bgf = BetaGeoFitter(penalizer_coef=0.001)
-bgf.fit(cltv['frequency'],
-        cltv['recency_cltv_weekly'],
-        cltv['T_weekly'])
-
-# Predicting expected purchases for the next 3 months
-###################################################
-cltv["expected_sales_3_month"] = bgf.predict(4 * 3, cltv['frequency'],
-                                             cltv['recency_cltv_weekly'],
-                                             cltv['T_weekly'])
-# Top 10 customers
-cltv["expected_sales_3_month"].nlargest(10)
-
-# Predicting expected purchases for the next 6 months
-###################################################
-cltv["expected_sales_6_month"] = bgf.predict(4 * 6, cltv['frequency'],
-                                             cltv['recency_cltv_weekly'],
-                                             cltv['T_weekly'])
-# Top 10 customers
-cltv["expected_sales_6_month"].nlargest(10)
-
-# Plotting the transactional behavior
-#####################################
-plot_period_transactions(bgf)
-plt.show(block=True)
-
-# B. Predicting average value per transaction using the Gamma-Gamma model
-#########################################################################
-
-# Fitting the Gamma-Gamma model
-###############################
-ggf = GammaGammaFitter(penalizer_coef=0.01)
-ggf.fit(cltv['frequency'], cltv['monetary_cltv_avg'])
-
-# Calculating the expected average value per transaction
-########################################################
-cltv["exp_average_value"] = ggf.conditional_expected_average_profit(cltv['frequency'],
-                                                                    cltv['monetary_cltv_avg'])
-cltv.sort_values("exp_average_value", ascending=False).head(10)
-
-# C. Calculating 6-month CLTV
-#############################
-CLTV = ggf.customer_lifetime_value(bgf, cltv['frequency'],
-                                   cltv['recency_cltv_weekly'],
-                                   cltv['T_weekly'],
-                                   cltv['monetary_cltv_avg'],
-                                   time=6, freq="W", discount_rate=0.01)
-
-CLTV = CLTV.reset_index()
-cltv_final = cltv.merge(CLTV, left_index=True, right_index=True, how='outer')
-
-# Sorting the customers based on CLTV
-#######################################################################
-cltv_final.sort_values(by="clv", ascending=False).head(20)
-
-###############################################################################
-# 4. Creating Segments Based on CLTV Value
-###############################################################################
-# Divide all customers into 4 segments based on 6-month CLTV
-#############################################################
-cltv_final["segment"] = pd.qcut(cltv_final["clv"], 4, labels=["D", "C", "B", "A"])
-
-cltv_final.sort_values(by="clv", ascending=False).head(10)
-
-cltv_final.groupby("segment").agg({"count", "mean", "sum"})
-
-
-# IMPORTANT NOTE: Assumptions of BG-NBD and Gamma-Gamma models:
-# There should be no corr between Freq ve monetary,
-# Freq should not ne float.
-# Graphs are shown below:
-cltv[['frequency','monetary_cltv_avg']].corr()
-cltv["frequency"]=cltv["frequency"].astype(int)
-plt.hist(cltv["frequency"])
-plt.show(block=True)
-cltv["frequency"].value_counts().sort_values(ascending=False)
-
-# The function for all data process - includes all the steps above
-def create_cltv_df(dataframe):
+    low_limit = np.round(low_limit)
+    up_limit = np.round(up_limit)
+    # single vectorized pass instead of two masked .loc writes
+    dataframe[variable] = np.clip(dataframe[variable].to_numpy(dtype=float), low_limit, up_limit)
+
+# Define the BatchBetaGeoFitter class to predict several horizons with shared BG/NBD terms
+##########################################################################################
+class BatchBetaGeoFitter(BetaGeoFitter):
+
+    def batch_predict(self, ts, frequency, recency, T):
+        """Same as predict(t, frequency, recency, T) for every t in ts; returns one row per t."""
+        r, alpha, a, b = self._unload_params("r", "alpha", "a", "b")
+        x = np.asarray(frequency, dtype=float)
+        t_x = np.asarray(recency, dtype=float)
+        T = np.asarray(T, dtype=float)
+
+        # terms that do not depend on the horizon, including the logs, are computed once per customer
+        _a = r + x
+        _b = b + x
+        _c = a + b + x - 1
+        log_alpha_T = np.log(alpha + T)
+        first_term = _c / (a - 1)
+        denominator = 1 + (x > 0) * (a / (b + x - 1)) * np.exp(_a * (log_alpha_T - np.log(alpha + t_x)))
+
+        # only hyp2f1 and log(alpha + T + t) are evaluated per horizon
+        purchases = np.empty((len(ts), len(x)))
+        for i, t in enumerate(ts):
+            _z = t / (alpha + T + t)
+            ln_hyp_term = np.log(hyp2f1(_a, _b, _c, _z))
+            ln_hyp_term_alt = np.log(hyp2f1(_c - _a, _c - _b, _c, _z)) + (_c - _a - _b) * np.log(1 - _z)
+            ln_hyp_term = np.where(np.isinf(ln_hyp_term), ln_hyp_term_alt, ln_hyp_term)
+            second_term = 1 - np.exp(ln_hyp_term + _a * (log_alpha_T - np.log(alpha + T + t)))
+            purchases[i] = first_term * second_term / denominator
+        return purchases
+
+# Define the fit_bgnbd and fit_gamma_gamma functions to fit the models
+# (on a random subsample for large data, the parameters are population-level;
+# fitted models are cached on disk and reused while the inputs do not change)
+#############################################################################
+# next to this script, so the cache does not depend on the directory it is run from
+CACHE_DIR = pathlib.Path(__file__).resolve().parent / ".cache"
+# bump CACHE_VERSION whenever the fitting code changes, so models fitted by the old code are not reused
+CACHE_VERSION = 2
+
+def cache_path(name, *arrays):
+    """Cache file for a model fitted on exactly these arrays and this code version, keyed on their xxhash64."""
+    digest = xxhash.xxh64(f"{CACHE_VERSION}-{lifetimes.__version__}".encode())
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    CACHE_DIR.mkdir(exist_ok=True)
+    return CACHE_DIR / f"{name}_{digest.hexdigest()}.pkl"
+
+def fit_sample(n, sample_size=50_000, seed=0):
+    """Rows used for fitting: all of them up to sample_size, otherwise a uniform random subsample."""
+    if n <= sample_size:
+        return slice(None)
+    rng = np.random.default_rng(seed)
+    return np.sort(rng.choice(n, size=sample_size, replace=False))
+
+@njit(cache=True)
+def _digamma(x):
+    # recurrence up to x >= 6, then the asymptotic series
+    result = 0.0
+    while x < 6.0:
+        result -= 1.0 / x
+        x += 1.0
+    f = 1.0 / (x * x)
+    return result + math.log(x) - 0.5 / x - f * (1 / 12 - f * (1 / 120 - f * (1 / 252 - f * (1 / 240 - f / 132))))
+
+@njit(fastmath=True, cache=True)
+def bgnbd_nll(log_params, freq, rec, T, penalizer_coef):
+    """BG/NBD negative log-likelihood of lifetimes' BetaGeoFitter and its gradient w.r.t. the log parameters."""
+    r = math.exp(log_params[0])
+    alpha = math.exp(log_params[1])
+    a = math.exp(log_params[2])
+    b = math.exp(log_params[3])
+    # customer-independent terms are computed once per call
+    log_alpha = math.log(alpha)
+    log_a = math.log(a)
+    const_1 = r * log_alpha - math.lgamma(r)
+    const_2 = math.lgamma(a + b) - math.lgamma(b)
+    digamma_r = _digamma(r)
+    digamma_ab = _digamma(a + b)
+    digamma_b = _digamma(b)
+
+    n = freq.shape[0]
+    ll = 0.0
+    grad = np.zeros(4)  # d ll / d (r, alpha, a, b)
+    for i in range(n):
+        x = freq[i]
+        log_alpha_T = math.log(alpha + T[i])
+        log_alpha_rec = math.log(alpha + rec[i])
+        A_1 = math.lgamma(r + x) + const_1
+        A_2 = const_2 + math.lgamma(b + x) - math.lgamma(a + b + x)
+        A_3 = -(r + x) * log_alpha_T
+        if x > 0:
+            A_4 = log_a - math.log(b + x - 1) - (r + x) * log_alpha_rec
+            max_A_3_A_4 = max(A_3, A_4)
+            w_3 = math.exp(A_3 - max_A_3_A_4)
+            w_4 = math.exp(A_4 - max_A_3_A_4)
+            ll += A_1 + A_2 + max_A_3_A_4 + math.log(w_3 + w_4)
+            p_3 = w_3 / (w_3 + w_4)
+            p_4 = 1.0 - p_3
+        else:
+            ll += A_1 + A_2 + A_3
+            p_3 = 1.0
+            p_4 = 0.0
+        digamma_abx = _digamma(a + b + x)
+        grad[0] += _digamma(r + x) - digamma_r + log_alpha - p_3 * log_alpha_T - p_4 * log_alpha_rec
+        grad[1] += r / alpha - (r + x) * (p_3 / (alpha + T[i]) + p_4 / (alpha + rec[i]))
+        grad[2] += digamma_ab - digamma_abx + p_4 / a
+        grad[3] += digamma_ab + _digamma(b + x) - digamma_b - digamma_abx - p_4 / (b + x - 1)
+
+    params = np.array([r, alpha, a, b])
+    nll = -ll / n + penalizer_coef * np.sum(params ** 2)
+    return nll, params * (2 * penalizer_coef * params - grad / n)
+
+def _attach_data(bgf, frequency, recency, T):
+    # the data and simulator BetaGeoFitter.fit sets, used by lifetimes.plotting
+    bgf.data = pd.DataFrame({"frequency": frequency, "recency": recency, "T": T,
+                             "weights": np.ones_like(frequency)})
+    bgf.generate_new_data = lambda size=1: beta_geometric_nbd_model(
+        T, *bgf._unload_params("r", "alpha", "a", "b"), size=size)
+    bgf.predict = bgf.conditional_expected_number_of_purchases_up_to_time
+
+def fit_bgnbd(frequency, recency, T, penalizer_coef=0.001, sample_size=50_000):
+    """Fit a BatchBetaGeoFitter with L-BFGS-B on bgnbd_nll instead of lifetimes' autograd optimizer."""
+    idx = fit_sample(len(frequency), sample_size)
+    frequency = np.asarray(frequency)[idx].astype(int)
+    recency = np.asarray(recency)[idx]
+    T = np.asarray(T)[idx]
+    bgf = BatchBetaGeoFitter(penalizer_coef=penalizer_coef)
+    path = cache_path(f"bgnbd_{penalizer_coef}", frequency, recency, T)
+    if path.exists():
+        bgf.load_model(path)
+        _attach_data(bgf, frequency, recency, T)
+        return bgf
+    scale = _scale_time(T)
+    # the kernel reads int32/float32 copies of the inputs, halving its memory traffic; it sums in double precision
+    nll_args = (frequency.astype(np.int32), (recency * scale).astype(np.float32),
+                (T * scale).astype(np.float32), penalizer_coef)
+    output = minimize(bgnbd_nll, x0=0.1 * np.ones(4), jac=True, method="L-BFGS-B", args=nll_args,
+                      options={"ftol": 1e-12, "gtol": 1e-8})
+    if not output.success:
+        # same as lifetimes' BaseFitter._fit; nothing is cached for a failed fit
+        raise ConvergenceError(
+            "The model did not converge. Try adding a larger penalizer to see if that helps convergence.")
+    # the fitter is filled in from the optimum the way BetaGeoFitter.fit does it; the Hessian at the
+    # optimum is taken by central differences of the analytic gradient
+    step = 1e-5
+    hessian_ = np.array([(bgnbd_nll(output.x + e, *nll_args)[1] - bgnbd_nll(output.x - e, *nll_args)[1]) / (2 * step)
+                         for e in step * np.eye(4)])
+    bgf._scale = scale
+    bgf._negative_log_likelihood_ = output.fun
+    bgf._hessian_ = (hessian_ + hessian_.T) / 2
+    bgf.params_ = pd.Series(np.exp(output.x), index=["r", "alpha", "a", "b"])
+    bgf.params_["alpha"] /= scale
+    _attach_data(bgf, frequency, recency, T)
+    bgf.variance_matrix_ = bgf._compute_variance_matrix()
+    bgf.standard_errors_ = bgf._compute_standard_errors()
+    bgf.confidence_intervals_ = bgf._compute_confidence_intervals()
+    # only the parameters are stored, the data is attached again from the inputs on loading
+    bgf.save_model(path, save_data=False, save_generate_data_method=False)
+    return bgf
+
+def fit_gamma_gamma(frequency, monetary_value, penalizer_coef=0.01, sample_size=50_000):
+    """Fit a GammaGammaFitter on at most sample_size customers."""
+    idx = fit_sample(len(frequency), sample_size)
+    frequency = np.asarray(frequency)[idx]
+    monetary_value = np.asarray(monetary_value)[idx]
+    ggf = GammaGammaFitter(penalizer_coef=penalizer_coef)
+    path = cache_path(f"gamma_gamma_{penalizer_coef}", frequency, monetary_value)
+    if path.exists():
+        ggf.load_model(path)
+        return ggf
+    ggf.fit(frequency, monetary_value)
+    ggf.save_model(path, save_data=False)
+    return ggf
+
+def _fit_into_cache(fit, *args, **kwargs):
+    # a fitted BetaGeoFitter holds a lambda and cannot be pickled back from a worker, it is read from the cache
+    fit(*args, **kwargs)
+
+def fit_models(frequency, recency, T, monetary_value, parallel_threshold=50_000,
+               bgnbd_penalizer=0.001, gamma_gamma_penalizer=0.01):
+    """Fit the BG/NBD and Gamma-Gamma models, in two processes when there are more than parallel_threshold customers."""
+    if len(frequency) > parallel_threshold:
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            fits = [executor.submit(_fit_into_cache, fit_bgnbd, frequency, recency, T,
+                                    penalizer_coef=bgnbd_penalizer),
+                    executor.submit(_fit_into_cache, fit_gamma_gamma, frequency, monetary_value,
+                                    penalizer_coef=gamma_gamma_penalizer)]
+            for future in fits:
+                future.result()
+    # the same penalizers as in the workers, so both fits are read back from the cache
+    return (fit_bgnbd(frequency, recency, T, penalizer_coef=bgnbd_penalizer),
+            fit_gamma_gamma(frequency, monetary_value, penalizer_coef=gamma_gamma_penalizer))
+
+# Define the customer_lifetime_value function to discount every period from a single BG/NBD evaluation
+########################################################################################################
+def customer_lifetime_value(bgf, frequency, recency, T, exp_average_value, time=6, freq="W", discount_rate=0.01):
+    """Same as ggf.customer_lifetime_value(bgf, ...), given the Gamma-Gamma expected average value."""
+    factor = {"W": 4.345, "M": 1.0, "D": 30, "H": 30 * 24}[freq]
+    steps = np.arange(time + 1)
+    # cumulative purchases at the end of every period, the differences are the purchases within each period
+    purchases = np.diff(bgf.batch_predict(steps * factor, frequency, recency, T), axis=0)
+    discount = (1 + discount_rate) ** -steps[1:, None]
+    return np.asarray(exp_average_value) * (purchases * discount).sum(axis=0)
+
+# The function for all data process
+# (the date variables must already be parsed, as done by read_csv below;
+# with return_models=True the fitted bgf and ggf are returned together with the cltv dataframe)
+def create_cltv_df(dataframe, verbose=False, return_models=False):
     # 1 - Data Preparation
+    check_df(dataframe, verbose=verbose)
     columns = ["order_num_total_ever_online", "order_num_total_ever_offline",
                "customer_value_total_ever_offline","customer_value_total_ever_online"]
-    for col in columns:
-        replace_with_thresholds(dataframe, col)
+    replace_with_thresholds(dataframe, columns)
     dataframe["order_num_total"] = dataframe["order_num_total_ever_online"] + dataframe["order_num_total_ever_offline"]
     dataframe["customer_value_total"] = dataframe["customer_value_total_ever_offline"] + dataframe["customer_value_total_ever_online"]
-    date_columns = dataframe.columns[dataframe.columns.str.contains("date")]
-    dataframe[date_columns] = dataframe[date_columns].apply(pd.to_datetime)
 
     # 2 - Preparing Data for CLTV Calculation
-    df["last_order_date"].max()
+    # The analysis date is 2 days after the last purchase in the dataset (2021-05-30).
     analysis_date = dt.datetime(2021, 6, 3)
-    cltv= pd.DataFrame()
-    cltv["customer_id"] = dataframe["master_id"]
-    cltv["recency_cltv_weekly"] = (dataframe["last_order_date"] - dataframe["first_order_date"]).dt.days // 7
-    cltv["T_weekly"] = (analysis_date - dataframe["first_order_date"]).dt.days // 7
-    cltv["frequency"] = dataframe["order_num_total"]
-    cltv = cltv[(cltv['frequency'] > 1)]
-    cltv["monetary_cltv_avg"] = dataframe["customer_value_total"] / cltv['frequency']
+    # Only customers with more than one purchase are kept; week counts are computed on the int64
+    # nanosecond values of the dates and stored as float, the dtype batch_predict works in.
+    repeat_customers = (dataframe["order_num_total"] > 1).to_numpy()
+    week_ns = np.int64(7 * 86_400 * 1_000_000_000)
+    first_order = dataframe["first_order_date"].to_numpy(dtype="datetime64[ns]").view("i8")[repeat_customers]
+    last_order = dataframe["last_order_date"].to_numpy(dtype="datetime64[ns]").view("i8")[repeat_customers]
+    analysis_ns = np.datetime64(analysis_date, "ns").astype(np.int64)
+    order_num_total = dataframe["order_num_total"].to_numpy()[repeat_customers]
+    cltv = {"customer_id": dataframe["master_id"].to_numpy()[repeat_customers],
+            "recency_cltv_weekly": ((last_order - first_order) // week_ns).astype(float),
+            "T_weekly": ((analysis_ns - first_order) // week_ns).astype(float),
+            "frequency": order_num_total.astype(int),
+            "monetary_cltv_avg": dataframe["customer_value_total"].to_numpy()[repeat_customers] / order_num_total}
     # 3. Calculating CLTV with BG/NBD and Gamma-Gamma Models
-    # Fitting the BG/NBD model
-    bgf = BetaGeoFitter(penalizer_coef=0.001)
-    bgf.fit(cltv['frequency'],
-            cltv['recency_cltv_weekly'],
-            cltv['T_weekly'])
-    # Predicting expected purchases for the next 3 months
-    cltv["expected_sales_3_month"] = bgf.predict(4 * 3, cltv['frequency'],
-                                                 cltv['recency_cltv_weekly'],
-                                                 cltv['T_weekly'])
-       # Predicting expected purchases for the next 6 months
-    cltv["expected_sales_6_month"] = bgf.predict(4 * 6, cltv['frequency'],
-                                                 cltv['recency_cltv_weekly'],
-                                                 cltv['T_weekly'])
-    # Fitting the Gamma-Gamma model
-    ggf = GammaGammaFitter(penalizer_coef=0.01)
-    ggf.fit(cltv['frequency'], cltv['monetary_cltv_avg'])
+    # Fitting the BG/NBD and Gamma-Gamma models
+    bgf, ggf = fit_models(cltv['frequency'],
+                          cltv['recency_cltv_weekly'],
+                          cltv['T_weekly'],
+                          cltv['monetary_cltv_avg'])
+    # Predicting expected purchases for the next 3 and 6 months
+    cltv["expected_sales_3_month"], cltv["expected_sales_6_month"] = bgf.batch_predict([4 * 3, 4 * 6],
+                                                                                       cltv['frequency'],
+                                                                                       cltv['recency_cltv_weekly'],
+                                                                                       cltv['T_weekly'])
     # Calculating the expected average value per transaction
     cltv["exp_average_value"] = ggf.conditional_expected_average_profit(cltv['frequency'],
                                                                         cltv['monetary_cltv_avg'])
 
     # Calculating 6-month CLTV
-    CLTV = ggf.customer_lifetime_value(bgf, cltv['frequency'],
-                                       cltv['recency_cltv_weekly'],
-                                       cltv['T_weekly'],
-                                       cltv['monetary_cltv_avg'],
-                                       time=6, freq="W", discount_rate=0.01)
-    CLTV = CLTV.reset_index()
-    cltv_final = cltv.merge(CLTV, left_index=True, right_index=True, how='outer')
+    cltv["clv"] = customer_lifetime_value(bgf, cltv['frequency'],
+                                          cltv['recency_cltv_weekly'],
+                                          cltv['T_weekly'],
+                                          cltv['exp_average_value'],
+                                          time=6, freq="W", discount_rate=0.01)
+    # All columns are computed, the cltv arrays are turned into a dataframe once.
+    cltv_final = pd.DataFrame(cltv)
     # 4. Creating Segments Based on CLTV Value
     # Divide all customers into 4 segments based on 6-month CLTV
-    cltv_final["segment"] = pd.qcut(cltv_final["clv"], 4, labels=["D", "C", "B", "A"])
+    segment_edges = np.quantile(cltv_final["clv"], [0.25, 0.5, 0.75])
+    segment_codes = np.searchsorted(segment_edges, cltv_final["clv"])
+    cltv_final["segment"] = pd.Categorical.from_codes(segment_codes, categories=["D", "C", "B", "A"], ordered=True)
 
+    if return_models:
+        return cltv_final, bgf, ggf
     return cltv_final
 
-cltv_final = create_cltv_df(df)
+###############################################################
+# Running the whole process
+###############################################################
+if __name__ == '__main__':
+    # The plots are only drawn when the script is run directly, importing it does not load matplotlib.
+    import matplotlib.pyplot as plt
+    from lifetimes.plotting import plot_period_transactions
+
+    # Arrow reader and Arrow-backed dtypes; the date variables are parsed while reading.
+    df_ = pd.read_csv('Datasets/flo_data_20k.csv', engine='pyarrow', dtype_backend='pyarrow',
+                      parse_dates=['first_order_date', 'last_order_date',
+                                   'last_order_date_online', 'last_order_date_offline'])
+    # interested_in_categories_12 is parsed once into an Arrow list<string> column, "[ERKEK, KADIN]" -> ['ERKEK', 'KADIN'],
+    # so it can be queried with the vectorized .list accessor and pyarrow.compute list kernels.
+    categories = pc.utf8_trim(pa.array(df_['interested_in_categories_12']), '[]')
+    categories = pc.if_else(pc.equal(categories, ''), pa.scalar([], pa.list_(pa.string())),
+                            pc.split_pattern(categories, pattern=', '))
+    df_['interested_in_categories_12'] = pd.Series(pd.arrays.ArrowExtensionArray(categories), index=df_.index)
+    check_df(df_)
+
+    cltv_final, bgf, ggf = create_cltv_df(df_.copy(), return_models=True)
+
+    # Sorting the customers based on CLTV
+    print(cltv_final.sort_values(by="clv", ascending=False).head(20))
+
+    # Plotting the transactional behavior of the BG/NBD model fitted in create_cltv_df
+    plot_period_transactions(bgf)
+    plt.show(block=True)
+
+    # Count, mean and sum of clv per segment, from the segment codes in a single pass
+    segment_codes = cltv_final["segment"].cat.codes.to_numpy()
+    segment_counts = np.bincount(segment_codes, minlength=4)
+    segment_sums = np.bincount(segment_codes, weights=cltv_final["clv"], minlength=4)
+    print(pd.DataFrame({"count": segment_counts, "mean": segment_sums / segment_counts, "sum": segment_sums},
+                       index=pd.Index(["D", "C", "B", "A"], name="segment")))
+
+    # IMPORTANT NOTE: Assumptions of BG-NBD and Gamma-Gamma models:
+    # There should be no corr between Freq ve monetary,
+    # Freq should not ne float (it is int).
+    # Graphs are shown below:
+    print(cltv_final[['frequency','monetary_cltv_avg']].corr())
+    plt.hist(cltv_final["frequency"])
+    plt.show(block=True)